@@ -0,0 +1,89 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http:# mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from collections import OrderedDict
+
+from infinite_queue.utils import RESTART_LINES
+from mo_threads import Lock
+from mo_times import Timer
+
+
+class BlockCache:
+    """
+    LEAST-RECENTLY-USED CACHE OF ARCHIVED BLOCKS, AS PAGES OF RESTART_LINES LINES
+    SO REPLAY SUBSCRIBERS DO NOT PUSH ARCHIVED MESSAGES BACK THROUGH THE DATABASE
+    A PAGE IS READ FROM ITS RESTART POINT, NOT FROM THE START OF THE BLOCK
+    """
+
+    def __init__(self, backing, size_mb):
+        self.backing = backing
+        self.max_size = size_mb * 1024 * 1024
+        self.lock = Lock("block cache")
+        self.pages = OrderedDict()  # MAP FROM (key, page) TO (lines, size), OLDEST FIRST
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get_line(self, key, index):
+        """
+        :param key: THE BACKING KEY OF THE BLOCK
+        :param index: LINE NUMBER IN THE BLOCK
+        :return: THE LINE, OR None IF THE BLOCK IS SHORTER
+        """
+        page = index // RESTART_LINES
+        lines = self.get_page(key, page)
+        index -= page * RESTART_LINES
+        if index < len(lines):
+            return lines[index]
+        return None
+
+    def get_page(self, key, page):
+        """
+        :return: LIST OF LINES ON THE GIVEN page OF THE BLOCK
+        """
+        with self.lock:
+            found = self.pages.get((key, page))
+            if found:
+                self.pages.move_to_end((key, page))
+                self.hits += 1
+                return found[0]
+            self.misses += 1
+
+        start = page * RESTART_LINES
+        with Timer("load lines {{start}} from {{key}}", param={"key": key, "start": start}):
+            lines = list(self.backing.read_lines(key, start, start + RESTART_LINES))
+        size = sum(len(line) + 1 for line in lines)
+
+        with self.lock:
+            if (key, page) not in self.pages:
+                self.pages[(key, page)] = lines, size
+                self.size += size
+            while self.size > self.max_size and self.pages:
+                _, (_, old_size) = self.pages.popitem(last=False)
+                self.size -= old_size
+        return lines
+
+    def forget(self, key):
+        """
+        THE BLOCK WAS REWRITTEN, OR REMOVED; DO NOT SERVE THE OLD LINES
+        """
+        with self.lock:
+            for k in [k for k in self.pages if k[0] == key]:
+                _, size = self.pages.pop(k)
+                self.size -= size
+
+    @property
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "pages": len(self.pages),
+                "size": self.size,
+            }
@@ -0,0 +1,112 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http:# mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from bisect import bisect_left, bisect_right
+
+from infinite_queue.utils import BLOCKS
+from jx_sqlite.sqlite import sql_query
+from jx_sqlite.utils import rows
+from mo_dots import Data
+from mo_threads import Lock
+
+
+class BlockIndex:
+    """
+    SORTED, IN-MEMORY COPY OF THE blocks TABLE FOR ONE QUEUE
+    SO FINDING THE ARCHIVE HOLDING A SERIAL DOES NOT HIT THE DATABASE
+    """
+
+    def __init__(self, queue):
+        self.lock = Lock("blocks for " + queue.name)
+        self.serials = []  # SORTED FIRST SERIAL OF EACH BLOCK
+        self.blocks = []  # Data(serial, last_serial, path, first_timestamp, last_timestamp), SAME ORDER
+
+        with queue.broker.db.transaction() as t:
+            result = t.query(
+                sql_query(
+                    {
+                        "select": [
+                            "serial",
+                            "last_serial",
+                            "path",
+                            "first_timestamp",
+                            "last_timestamp",
+                        ],
+                        "from": BLOCKS,
+                        "where": {"eq": {"queue": queue.id}},
+                        "orderby": "serial",
+                    }
+                )
+            )
+        for block in rows(result):
+            self.serials.append(block.serial)
+            self.blocks.append(block)
+
+    def find(self, serial):
+        """
+        :return: THE BLOCK HOLDING serial, OR None
+        """
+        with self.lock:
+            i = bisect_right(self.serials, serial) - 1
+            if i < 0:
+                return None
+            block = self.blocks[i]
+        if serial > block.last_serial:
+            return None
+        return block
+
+    def get(self, serial):
+        """
+        :return: THE BLOCK STARTING AT serial, OR None
+        """
+        with self.lock:
+            i = bisect_left(self.serials, serial)
+            if i < len(self.serials) and self.serials[i] == serial:
+                return self.blocks[i]
+        return None
+
+    def add(self, serial, last_serial, path, first_timestamp, last_timestamp):
+        """
+        ADD, OR REPLACE, THE BLOCK STARTING AT serial
+        """
+        block = Data(
+            serial=serial,
+            last_serial=last_serial,
+            path=path,
+            first_timestamp=first_timestamp,
+            last_timestamp=last_timestamp,
+        )
+        with self.lock:
+            i = bisect_left(self.serials, serial)
+            if i < len(self.serials) and self.serials[i] == serial:
+                self.blocks[i] = block
+            else:
+                self.serials.insert(i, serial)
+                self.blocks.insert(i, block)
+        return block
+
+    def remove(self, start, end):
+        """
+        REMOVE ALL BLOCKS STARTING IN [start, end)
+        :return: THE BLOCKS REMOVED
+        """
+        with self.lock:
+            i = bisect_left(self.serials, start)
+            j = bisect_left(self.serials, end)
+            removed = self.blocks[i:j]
+            del self.serials[i:j]
+            del self.blocks[i:j]
+        return removed
+
+    def __len__(self):
+        return len(self.serials)
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.blocks))
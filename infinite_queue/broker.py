@@ -8,10 +8,11 @@
 # Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
 #
 from infinite_queue import schema
+from infinite_queue.block_cache import BlockCache
+from infinite_queue.flusher import Flusher
 from infinite_queue.queue import Queue, DEBUG
 from infinite_queue.subscription import Subscription
 from infinite_queue.utils import (
-    BLOCKS,
     VERSION_TABLE,
     QUEUE,
     SUBSCRIBER,
@@ -29,29 +30,48 @@ from jx_sqlite.sqlite import (
 from jx_sqlite.utils import first_row, rows
 from mo_future import first
 from mo_kwargs import override
-from mo_sql import ConcatSQL, SQL, JoinSQL, SQL_OR
+from mo_sql import SQL
 from mo_threads import Till, Signal, Thread
 from mo_times import Date, Duration
 from pyLibrary.aws import s3
 from vendor.mo_logs import Log
 
 WRITE_INTERVAL = "minute"
+CLEAN_BATCH = 10000  # MAXIMUM NUMBER OF SERIALS TO DELETE IN ONE TRANSACTION
 
 
 class Broker:
     @override
-    def __init__(self, backing, database, kwargs=None):
+    def __init__(
+        self,
+        backing,
+        database,
+        block_cache_mb=64,
+        flush_workers=2,
+        flush_queue_size=100,
+        kwargs=None,
+    ):
+        """
+        :param backing: WHERE BLOCKS ARE ARCHIVED (directory, OR s3 bucket)
+        :param database: SETTINGS FOR THE Sqlite STAGING DATABASE
+        :param block_cache_mb: MEMORY BUDGET FOR ARCHIVED BLOCKS READ BY REPLAYS
+        :param flush_workers: NUMBER OF THREADS WRITING BLOCKS TO THE BACKING
+        :param flush_queue_size: MAXIMUM NUMBER OF QUEUES WAITING TO BE FLUSHED
+        """
         if backing.directory:
             self.backing = DirectoryBacking(kwargs=backing)
         else:
             self.backing = s3.Bucket(kwargs=backing)
+        self.block_cache = BlockCache(self.backing, block_cache_mb)
         self.db = Sqlite(database)
 
         # ENSURE DATABASE IS SETUP
         if not self.db.about(VERSION_TABLE):
             schema.setup(self)
+        schema.upgrade(self)
         self.next_id = id_generator(db=self.db, version_table=VERSION_TABLE)
         self.queues = []
+        self.flusher = Flusher(flush_workers, flush_queue_size)
         self.please_stop = Signal()
         self.cleaner = Thread.run("cleaner", self._cleaner)
 
@@ -182,73 +202,111 @@ class Broker:
         """
         REMOVE ANY RECORDS THAT ARE NOT NEEDED BY QUEUE OR SUBSCRIBERS
         """
-        now = Date.now()
+        # ANY MESSAGES TO FLUSH?  THE FLUSHER WILL WRITE THEM, SO THEY ARE
+        # REMOVED IN A LATER clean()
+        for q in self.queues:
+            if q.block_end < q.next_serial:
+                self.flusher.add(q)
+
+        # REMOVE UNREACHABLE MESSAGES
+        for q in self.queues:
+            for start, end in self._unreachable(q):
+                self._delete_messages(q, start, end)
 
-        # ANY BLOCKS TO FLUSH?
+    def _unreachable(self, queue):
+        """
+        A MESSAGE IS NEEDED IF IT IS NOT WRITTEN TO BACKING YET (serial >= block_start),
+        OR IT IS IN SOME SUBSCRIBER'S WINDOW (last_confirmed_serial, next_emit_serial+look_ahead_serial),
+        OR IT IS STILL UNCONFIRMED
+        :return: SORTED LIST OF [start, end) SERIAL RANGES THAT CAN BE DELETED
+        """
         with self.db.transaction() as t:
             result = t.query(
                 SQL(
                     f"""
-                    SELECT id, block_size_mb, block_start
-                    FROM {QUEUE} AS q
-                    JOIN {BLOCKS} AS b ON b.queue=q.id AND b.serial=q.block_start
-                    WHERE b.last_used < {quote_value(now-Duration(WRITE_INTERVAL))}            
+                    SELECT last_confirmed_serial+1 AS start, next_emit_serial+look_ahead_serial AS end
+                    FROM {SUBSCRIBER}
+                    WHERE queue = {quote_value(queue.id)}
+                    UNION ALL
+                    SELECT min(serial) AS start, max(serial)+1 AS end
+                    FROM {UNCONFIRMED}
+                    WHERE subscriber IN (SELECT id FROM {SUBSCRIBER} WHERE queue = {quote_value(queue.id)})
+                    GROUP BY subscriber
+                    UNION ALL
+                    SELECT block_start AS start, NULL AS end
+                    FROM {QUEUE}
+                    WHERE id = {quote_value(queue.id)}
                     """
                 )
             )
 
-        for stale in rows(result):
-            queue = first(q for q in self.queues if q.id == stale.id)
-            queue._flush(**stale)
-
-        # REMOVE UNREACHABLE MESSAGES
-        conditions = []
-        for q in self.queues:
-            conditions.append(
-                SQL(f"(queue = {quote_value(q.id)} AND serial IN (")
-                + SQL(
-                    f"""
-                    SELECT m.serial
-                    FROM {MESSAGES} AS m 
-                    LEFT JOIN {UNCONFIRMED} as u ON u.serial = m.serial
-                    LEFT JOIN {SUBSCRIBER} as s  ON s.queue = m.queue and s.id = u.subscriber 
-                    LEFT JOIN {QUEUE} as q ON q.id = m.queue and m.serial >= q.block_start
-                    LEFT JOIN {SUBSCRIBER} as la ON 
-                        la.queue = m.queue AND 
-                        la.last_confirmed_serial < m.serial AND 
-                        m.serial < la.next_emit_serial+la.look_ahead_serial
-                    WHERE 
-                        m.queue = {q.id} AND
-                        s.id IS NULL AND -- STILL UNCONFIRMED POP
-                        q.id IS NULL AND -- NOT WRITTEN TO S3 YET
-                        la.id IS NULL    -- NOT IN LOOK-AHEAD FOR SUBSCRIBER           
-                    """
-                )
-                + SQL("))")
-            )
+        output = []
+        start = 1
+        for keep_start, keep_end in sorted(result.data, key=lambda r: r[0]):
+            if keep_end is not None and keep_start >= keep_end:
+                continue
+            if start < keep_start:
+                output.append((start, keep_start))
+            if keep_end is None:
+                break
+            start = max(start, keep_end)
+        return output
 
-        with self.db.transaction() as t:
-            if DEBUG:
+    def _delete_messages(self, queue, start, end):
+        """
+        DELETE MESSAGES IN [start, end), CLEAN_BATCH SERIALS AT A TIME
+        SO OTHER TRANSACTIONS ARE NOT BLOCKED FOR LONG
+        """
+        while start < end:
+            with self.db.transaction() as t:
                 result = t.query(
-                    ConcatSQL(
-                        SQL(f"SELECT count(1) AS `count` FROM {MESSAGES} WHERE "),
-                        JoinSQL(SQL_OR, conditions),
+                    SQL(
+                        f"""
+                        SELECT min(serial) AS serial
+                        FROM {MESSAGES}
+                        WHERE 
+                            queue = {quote_value(queue.id)} AND
+                            {quote_value(start)} <= serial AND
+                            serial < {quote_value(end)}
+                        """
                     )
                 )
-                Log.note(
-                    "Delete {{num}} messages from database", num=first_row(result).count
+                start = first_row(result).serial
+                if start is None:
+                    return
+                batch_end = min(start + CLEAN_BATCH, end)
+                DEBUG and Log.note(
+                    "Delete messages [{{start}}, {{end}}) of {{queue}} from database",
+                    start=start,
+                    end=batch_end,
+                    queue=queue.name,
                 )
-
-            t.execute(
-                ConcatSQL(
-                    SQL(f"DELETE FROM {MESSAGES} WHERE "), JoinSQL(SQL_OR, conditions)
+                t.execute(
+                    SQL(
+                        f"""
+                        DELETE FROM {MESSAGES}
+                        WHERE 
+                            queue = {quote_value(queue.id)} AND
+                            {quote_value(start)} <= serial AND
+                            serial < {quote_value(batch_end)}
+                        """
+                    )
                 )
-            )
+            start = batch_end
+
+    def flush_lag(self):
+        """
+        :return: MAP FROM QUEUE NAME TO ITS flush_lag()
+        """
+        return {q.name: q.flush_lag() for q in self.queues}
 
     def close(self):
         self.please_stop.go()
+        self.cleaner.stop()
+        self.cleaner.join()
         for q in self.queues:
-            q.flush()
+            self.flusher.add(q)
+        self.flusher.close()
         self.db.close()
 
     def _cleaner(self, please_stop):
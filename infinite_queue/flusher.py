@@ -0,0 +1,88 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http:# mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from mo_future import text
+from mo_logs import Log
+from mo_threads import Lock, Queue, Thread, THREAD_STOP
+
+DEBUG = True
+
+
+class Flusher:
+    """
+    WRITE BLOCKS TO THE BACKING IN WORKER THREADS, SO THE CLEANER, AND THE
+    PRODUCERS, DO NOT WAIT ON UPLOADS.  EACH QUEUE IS FLUSHED BY ONE WORKER AT
+    A TIME (ITS BLOCKS MUST BE RECORDED IN ORDER), SO workers QUEUES ARE
+    FLUSHED CONCURRENTLY
+    """
+
+    def __init__(self, workers, max_pending):
+        """
+        :param workers: NUMBER OF UPLOAD THREADS
+        :param max_pending: LIMIT ON THE NUMBER OF QUEUES WAITING FOR A WORKER
+        """
+        self.todo = Queue("flush requests", max=max_pending, silent=True)
+        self.lock = Lock("flusher")
+        self.pending = set()  # ids OF QUEUES WAITING FOR, OR IN, A WORKER
+        self.again = set()  # ids OF QUEUES TO FLUSH AGAIN WHEN THE WORKER IS DONE
+        self.workers = [
+            Thread.run("flush worker " + text(i), self._worker) for i in range(workers)
+        ]
+
+    def add(self, queue):
+        """
+        REQUEST queue BE FLUSHED; BLOCKS IF TOO MANY REQUESTS ARE PENDING
+        """
+        with self.lock:
+            if queue.id in self.pending:
+                self.again.add(queue.id)
+                return
+            self.pending.add(queue.id)
+        self.todo.add(queue)
+
+    def wait(self, till=None):
+        """
+        WAIT FOR ALL REQUESTED FLUSHES TO FINISH
+        :return: True IF DONE, False IF till WAS SIGNALED
+        """
+        with self.lock:
+            while self.pending:
+                if till:
+                    return False
+                self.lock.wait(till=till)
+        return True
+
+    def close(self):
+        self.wait()
+        for w in self.workers:
+            w.stop()
+        for w in self.workers:
+            w.join()
+
+    def _worker(self, please_stop):
+        while not please_stop:
+            queue = self.todo.pop(till=please_stop)
+            if queue is None or queue is THREAD_STOP:
+                continue
+            try:
+                queue.flush()
+                DEBUG and Log.note(
+                    "flushed {{queue}}, lag is {{lag|json}}",
+                    queue=queue.name,
+                    lag=queue.flush_lag(),
+                )
+            except Exception as e:
+                Log.warning("Problem flushing {{queue}}", queue=queue.name, cause=e)
+            with self.lock:
+                if queue.id in self.again:
+                    # MORE MESSAGES ARRIVED WHILE FLUSHING
+                    self.again.remove(queue.id)
+                    self.todo.add(queue, force=True)
+                else:
+                    self.pending.remove(queue.id)
@@ -9,198 +9,341 @@
 #
 from mo_sql import SQL
 
+from infinite_queue.block_index import BlockIndex
 from infinite_queue.utils import MESSAGES, QUEUE, BLOCKS, _path
 from jx_sqlite.sqlite import sql_insert, sql_query, sql_update, quote_value
 from jx_sqlite.utils import first_row, rows
 from mo_dots import listwrap, Data, wrap
-from mo_future import first, text
+from mo_future import text
 from mo_json import value2json, json2value
 from mo_kwargs import override
-from mo_times import Date, Timer
+from mo_threads import Lock
+from mo_times import Date
 from vendor.mo_logs import Log
 
 DEBUG = True
+SERIAL_CHUNK = 1000  # NUMBER OF SERIALS TO RESERVE IN THE DATABASE AT A TIME
+FLUSH_PAGE = 1000  # NUMBER OF MESSAGES TO READ AT A TIME WHILE FLUSHING
 
 
 class Queue:
     @override
-    def __init__(self, id, broker, name):
+    def __init__(self, id, broker, name, next_serial=1, block_end=1):
         self.id = id
         self.broker = broker
         self.name = name
 
+        # ALL SERIALS BELOW next_serial ARE COMMITTED TO THE DATABASE
+        # queue.next_serial IN THE DATABASE IS A HIGH-WATER MARK, AT OR ABOVE self.next_serial
+        self.serial_lock = Lock("serial for " + name)
+        self.reserved_serial = next_serial
+        self.next_serial = self._recover_serial(block_end)
+        self.block_index = BlockIndex(self)
+
+        # ONLY ONE FLUSH AT A TIME; ALL SERIALS BELOW block_end ARE IN THE BACKING
+        self.flush_lock = Lock("flush for " + name)
+        self.block_end = block_end
+
     def push(self, message):
+        return self.push_many([message]).start
+
+    add = push
+
+    def push_many(self, messages):
+        """
+        PUSH ALL messages IN ONE TRANSACTION
+        :param messages: LIST OF JSON-SERIALIZABLE OBJECTS
+        :return: range OF SERIALS ASSIGNED, IN THE SAME ORDER AS messages
+        """
         # DETERMINE ULTIMATE LOCATION
         #
         now = Date.now()
-        message = wrap(message)
+        path = _path(now)
+        messages = list(messages)
+        if not messages:
+            return range(0)
 
-        with self.broker.db.transaction() as t:
-            serial = self._next_serial(t)
-            key = self._key(path=_path(now), serial=serial)
-            message.etl = listwrap(message.etl)
-            message.etl.append(
-                {
-                    "queue": {
-                        "url": self.broker.backing.url(key),
-                        "timestamp": now,
-                        "date/time": now.format(),
+        with self.serial_lock:
+            start = self.next_serial
+            end = start + len(messages)
+            with self.broker.db.transaction() as t:
+                self._reserve_serials(t, end)
+                records = [
+                    {
+                        "queue": self.id,
                         "serial": serial,
+                        "timestamp": now,
+                    "content": self._markup(message, serial, path, now),
                     }
-                }
-            )
-            content = value2json(message, sort_keys=True)
-            t.execute(
-                sql_insert(
-                    MESSAGES, {"queue": self.id, "serial": serial, "content": content}
-                )
-            )
-        return serial
+                    for serial, message in enumerate(messages, start)
+                ]
+                t.execute(sql_insert(MESSAGES, records))
+            # MAKE VISIBLE TO SUBSCRIBERS ONLY AFTER COMMIT
+            self.next_serial = end
+        return range(start, end)
 
-    add = push
+    def _markup(self, message, serial, path, now):
+        """
+        ADD THE QUEUE'S etl RECORD, RETURN THE JSON
+        """
+        message = wrap(message)
+        key = self._key(path=path, serial=serial)
+        message.etl = listwrap(message.etl)
+        message.etl.append(
+            {
+                "queue": {
+                    "url": self.broker.backing.url(key),
+                    "timestamp": now,
+                    "date/time": now.format(),
+                    "serial": serial,
+                }
+            }
+        )
+        return value2json(message, sort_keys=True)
 
     def flush(self):
-        # ANY BLOCKS TO FLUSH?
-        with self.broker.db.transaction() as t:
-            result = t.query(
-                sql_query(
-                    {
-                        "select": ["block_size_mb", "block_start"],
-                        "from": QUEUE,
-                        "where": {"eq": {"id": self.id}},
-                    }
+        with self.flush_lock:
+            # ANY BLOCKS TO FLUSH?
+            with self.broker.db.transaction() as t:
+                result = t.query(
+                    sql_query(
+                        {
+                            "select": ["block_size_mb", "block_start", "block_end"],
+                            "from": QUEUE,
+                            "where": {"eq": {"id": self.id}},
+                        }
+                    )
                 )
-            )
-        self._flush(kwargs=first_row(result))
+            self._flush(kwargs=first_row(result))
 
-    @override
-    def _flush(self, block_size_mb, block_start):
+    def flush_lag(self):
+        """
+        :return: HOW FAR THE BACKING IS BEHIND: NUMBER OF messages, AND seconds
+                 SINCE THE OLDEST OF THEM WAS PUSHED
+        """
+        block_end = self.block_end
+        messages = self.next_serial - block_end
+        if messages <= 0:
+            return Data(messages=0, seconds=0)
         with self.broker.db.transaction() as t:
             result = t.query(
                 SQL(
                     f"""
-                SELECT
-                    serial,
-                    content
-                FROM
-                    {MESSAGES}
-                WHERE
-                    serial >= {quote_value(block_start)} AND
-                    queue = {quote_value(self.id)}
-                ORDER BY
-                    serial
-            """
+                    SELECT serial, timestamp, content
+                    FROM {MESSAGES}
+                    WHERE
+                        queue = {quote_value(self.id)} AND
+                        serial = {quote_value(block_end)}
+                    """
                 )
             )
+        oldest = first_row(result)
+        if not oldest:
+            return Data(messages=messages, seconds=0)
+        return Data(messages=messages, seconds=Date.now().unix - _timestamp(oldest))
 
-        if not result.data:
-            return
+    @override
+    def _flush(self, block_size_mb, block_start, block_end):
+        """
+        EXPECTING flush_lock
+        MESSAGES BELOW block_start ARE IN FULL BLOCKS
+        MESSAGES FROM block_start TO block_end ARE IN IMMUTABLE TAIL SEGMENTS
+        NEW MESSAGES ARE APPENDED AS ANOTHER SEGMENT, UNLESS THERE IS ENOUGH
+        FOR A FULL BLOCK; THEN THE SEGMENTS ARE MERGED
+        """
+        max_size = block_size_mb * 1024 * 1024
+        if self._staged_size(block_start) > max_size:
+            start = block_start
+        else:
+            start = block_end
 
         def chunk():
-            max_size = block_size_mb * 1024 * 1024
             acc = []
             size = 0
-            start = first_row(result).serial
-            for r in rows(result):
+            for r in self._read_messages(start):
                 s = len(r.content) + 1
                 if acc and s + size > max_size:
-                    yield acc, start, False
+                    yield acc, False
                     acc = []
-                    start = r.serial
-                acc.append(r.content)
+                    size = 0
+                acc.append(r)
                 size += s
             if acc:
                 if size > max_size:
-                    yield acc, start, False  # EXACT BLOCK SIZE
+                    yield acc, False  # EXACT BLOCK SIZE
                 else:
-                    yield acc, start, True
+                    yield acc, True
 
-        for lines, start, is_last in chunk():
-            etl_first = json2value(lines[0]).etl.last().queue
-            etl_last = json2value(lines[-1]).etl.last().queue
-            path = _path(etl_first.timestamp)
-            key = self._key(path=path, serial=etl_first.serial)
+        for block_rows, is_last in chunk():
+            first, last = block_rows[0], block_rows[-1]
+            first_timestamp, last_timestamp = _timestamp(first), _timestamp(last)
+            lines = [r.content for r in block_rows]
+            path = _path(first_timestamp)
+            key = self._key(path=path, serial=first.serial)
             Log.note("flush {{num}} lines to {{key}}", key=key, num=len(lines))
             self.broker.backing.write_lines(key, lines)
-            result = Data(block_end=etl_last.serial + 1)
+            self.broker.block_cache.forget(key)
+            block_end = max(block_end, last.serial + 1)
+            result = Data(block_end=block_end)
             if not is_last:
                 # UPDATE start TO MARK MESSAGES FOR DB REMOVAL
-                result.block_start = etl_last.serial + 1
+                result.block_start = last.serial + 1
 
             with self.broker.db.transaction() as t:
-                t.execute(sql_update(QUEUE, {"set": result}))
-                result = t.query(
-                    sql_query(
-                        {
-                            "select": "path",
-                            "from": BLOCKS,
-                            "where": {"eq": {
-                                "queue": self.id,
-                                "serial": etl_first.serial,
-                            }}
-                        }
+                t.execute(
+                    sql_update(
+                        QUEUE, {"set": result, "where": {"eq": {"id": self.id}}}
                     )
                 )
-                if result.data:
+                # SEGMENTS NOW COVERED BY THIS BLOCK
+                t.execute(
+                    SQL(
+                        f"""
+                        DELETE FROM {BLOCKS}
+                        WHERE
+                            queue = {quote_value(self.id)} AND
+                            serial > {quote_value(first.serial)} AND
+                            serial <= {quote_value(last.serial)}
+                        """
+                    )
+                )
+                block = {
+                    "path": path,
+                    "last_serial": last.serial,
+                    "first_timestamp": Date(first_timestamp),
+                    "last_timestamp": Date(last_timestamp),
+                    "last_used": Date.now(),
+                }
+                if self.block_index.get(first.serial):
                     t.execute(
                         sql_update(
                             BLOCKS,
                             {
-                                "set": {"last_used": Date.now()},
-                                "where": {"eq": {"queue": self.id, "serial": etl_first.serial}},
+                                "set": block,
+                                "where": {"eq": {"queue": self.id, "serial": first.serial}},
                             },
                         )
                     )
                 else:
                     t.execute(
                         sql_insert(
-                            BLOCKS,
-                            {
-                                "queue": self.id,
-                                "serial": etl_first.serial,
-                                "path": path,
-                                "last_used": Date.now(),
-                            },
+                            BLOCKS, {"queue": self.id, "serial": first.serial, **block}
                         )
                     )
+            self.block_end = block_end
+            self.block_index.add(
+                serial=first.serial,
+                last_serial=last.serial,
+                path=path,
+                first_timestamp=first_timestamp,
+                last_timestamp=last_timestamp,
+            )
+            for segment in self.block_index.remove(first.serial + 1, last.serial + 1):
+                segment_key = self._key(path=segment.path, serial=segment.serial)
+                self.broker.backing.delete_key(segment_key)
+                self.broker.block_cache.forget(segment_key)
 
-    def load(self, path, start):
-        key = self._key(path=path, serial=start)
+    def _staged_size(self, block_start):
+        """
+        :return: NUMBER OF BYTES (AS WRITTEN) OF MESSAGES NOT YET IN A FULL BLOCK
+        """
         with self.broker.db.transaction() as t:
-            with Timer("load lines from {{key}}", param={"key": key}):
-                for line in self.broker.backing.read_lines(key):
-                    s = json2value(line).etl.last().queue.serial
-                    t.execute(
-                        sql_insert(
-                            MESSAGES, {"serial": s, "queue": self.id, "content": line}
-                        )
+            result = t.query(
+                SQL(
+                    f"""
+                    SELECT sum(length(content)+1) AS size
+                    FROM {MESSAGES}
+                    WHERE
+                        serial >= {quote_value(block_start)} AND
+                        queue = {quote_value(self.id)}
+                    """
+                )
+            )
+        return first_row(result).size or 0
+
+    def _read_messages(self, start):
+        """
+        STREAM MESSAGES, IN serial ORDER, STARTING AT start
+        EACH PAGE OF FLUSH_PAGE ROWS IS A SEPARATE QUERY, SO MEMORY STAYS BOUNDED
+        """
+        while True:
+            with self.broker.db.transaction() as t:
+                result = t.query(
+                    SQL(
+                        f"""
+                    SELECT
+                        serial,
+                        timestamp,
+                        content
+                    FROM
+                        {MESSAGES}
+                    WHERE
+                        serial >= {quote_value(start)} AND
+                        queue = {quote_value(self.id)}
+                    ORDER BY
+                        serial
+                    LIMIT
+                        {quote_value(FLUSH_PAGE)}
+                """
                     )
+                )
+            for r in rows(result):
+                yield r
+            if len(result.data) < FLUSH_PAGE:
+                return
+            start = r.serial + 1
+
+    def load(self, path, start, serial):
+        """
+        :param path: path OF THE BLOCK
+        :param start: FIRST SERIAL IN THE BLOCK
+        :return: content OF THE serial MESSAGE, OR None IF NOT IN THE BLOCK
+        """
+        key = self._key(path=path, serial=start)
+        return self.broker.block_cache.get_line(key, serial - start)
 
     def _key(self, serial, path):
         return self.name + "/" + path + "/" + text(serial)
 
-    def _next_serial(self, t):
+    def _reserve_serials(self, t, end):
         """
-        EXPECTING AN OPEN TRANSACTION t
+        EXPECTING AN OPEN TRANSACTION t, AND serial_lock
+        ENSURE THE DATABASE HIGH-WATER MARK COVERS ALL SERIALS BELOW end
         """
-        result = t.query(
-            sql_query(
-                {
-                    "select": "next_serial",
-                    "from": QUEUE,
-                    "where": {"eq": {"id": self.id}},
-                }
-            )
-        )
-        (next_id,) = first(result.data)
-
+        if end <= self.reserved_serial:
+            return
+        reserved = end + SERIAL_CHUNK
         t.execute(
             sql_update(
                 QUEUE,
-                {
-                    "set": {"next_serial": next_id + 1},
-                    "where": {"eq": {"id": self.id}},
-                },
+                {"set": {"next_serial": reserved}, "where": {"eq": {"id": self.id}}},
             )
         )
-        return next_id
+        self.reserved_serial = reserved
+
+    def _recover_serial(self, block_end):
+        """
+        THE HIGH-WATER MARK MAY BE AHEAD OF THE LAST MESSAGE (AFTER A CRASH)
+        RECOVER THE NEXT SERIAL FROM THE MESSAGES, AND THE BLOCKS ALREADY WRITTEN
+        """
+        with self.broker.db.transaction() as t:
+            result = t.query(
+                SQL(
+                    f"""
+                    SELECT max(serial) AS serial
+                    FROM {MESSAGES}
+                    WHERE queue = {quote_value(self.id)}
+                    """
+                )
+            )
+        last = first_row(result).serial
+        return max(block_end, (last or 0) + 1)
+
+
+def _timestamp(row):
+    """
+    MESSAGES PUSHED BEFORE SCHEMA 4.0 HAVE NO timestamp; PARSE THE etl RECORD
+    """
+    if row.timestamp != None:
+        return row.timestamp
+    return json2value(row.content).etl.last().queue.timestamp
@@ -17,10 +17,18 @@ from infinite_queue.utils import (
 from jx_sqlite.sqlite import (
     sql_create,
     version_table,
+    sql_query,
+    sql_update,
 )
+from jx_sqlite.utils import first_row
+from mo_sql import SQL
+from vendor.mo_logs import Log
 
 
 def setup(broker):
+    """
+    CREATE THE VERSION 1.0 TABLES, upgrade() BRINGS THEM TO THE CURRENT VERSION
+    """
     version_table(db=broker.db, version_table=VERSION_TABLE)
 
     with broker.db.transaction() as t:
@@ -96,3 +104,118 @@ def setup(broker):
                 },
             )
         )
+
+
+def upgrade(broker):
+    """
+    MIGRATE AN EXISTING DATABASE, IN PLACE, TO THE CURRENT SCHEMA VERSION
+    """
+    with broker.db.transaction() as t:
+        result = t.query(sql_query({"select": "version", "from": VERSION_TABLE}))
+    version = _version(first_row(result).version)
+
+    for v, migrate in MIGRATIONS:
+        if version >= _version(v):
+            continue
+        Log.note("Upgrade database schema to {{version}}", version=v)
+        with broker.db.transaction() as t:
+            migrate(t)
+            t.execute(sql_update(VERSION_TABLE, {"set": {"version": v}}))
+
+
+def _version(version):
+    return tuple(int(v) for v in version.split("."))
+
+
+def _v2(t):
+    """
+    unconfirmed GETS A PRIMARY KEY, A FOREIGN KEY THAT EXISTS, AND AN INDEX FOR
+    FINDING OVERDUE MESSAGES
+    """
+    temp = UNCONFIRMED + "_v2"
+    t.execute(
+        sql_create(
+            table=temp,
+            properties={
+                "subscriber": "LONG NOT NULL",
+                "serial": "LONG NOT NULL",
+                "deliver_time": "DOUBLE NOT NULL",
+            },
+            primary_key=("subscriber", "serial"),
+            foreign_key={"subscriber": {"table": SUBSCRIBER, "column": "id"}},
+        )
+    )
+    t.execute(
+        SQL(
+            f"""
+            INSERT INTO {temp} (subscriber, serial, deliver_time)
+            SELECT subscriber, serial, max(deliver_time)
+            FROM {UNCONFIRMED}
+            GROUP BY subscriber, serial
+            """
+        )
+    )
+    t.execute(SQL(f"DROP TABLE {UNCONFIRMED}"))
+    t.execute(SQL(f"ALTER TABLE {temp} RENAME TO {UNCONFIRMED}"))
+    t.execute(
+        SQL(
+            f"""
+            CREATE INDEX {UNCONFIRMED}_deliver_time
+            ON {UNCONFIRMED} (subscriber, deliver_time, serial)
+            """
+        )
+    )
+    t.execute(
+        SQL(
+            f"""
+            CREATE INDEX {SUBSCRIBER}_queue
+            ON {SUBSCRIBER} (queue)
+            """
+        )
+    )
+
+
+def _v3(t):
+    """
+    blocks RECORD THEIR LAST SERIAL, AND THE TIME RANGE OF THEIR MESSAGES
+    OLDER BLOCKS GET A CONSERVATIVE TIME RANGE: THE DAY OF THEIR path, TO WHEN
+    THEY WERE LAST WRITTEN
+    """
+    for column, dtype in [
+        ("last_serial", "LONG"),
+        ("first_timestamp", "DOUBLE"),
+        ("last_timestamp", "DOUBLE"),
+    ]:
+        t.execute(SQL(f"ALTER TABLE {BLOCKS} ADD COLUMN {column} {dtype}"))
+    t.execute(
+        SQL(
+            f"""
+            UPDATE {BLOCKS} SET
+                last_serial = COALESCE(
+                    (
+                    SELECT min(b.serial)
+                    FROM {BLOCKS} AS b
+                    WHERE b.queue = {BLOCKS}.queue AND b.serial > {BLOCKS}.serial
+                    ),
+                    (
+                    SELECT q.block_end
+                    FROM {QUEUE} AS q
+                    WHERE q.id = {BLOCKS}.queue
+                    )
+                ) - 1,
+                first_timestamp = CAST(strftime('%s', replace(path, '/', '-')) AS DOUBLE),
+                last_timestamp = last_used
+            """
+        )
+    )
+
+
+def _v4(t):
+    """
+    messages CARRY THEIR timestamp, SO FLUSHING DOES NOT PARSE THE CONTENT
+    OLDER MESSAGES ARE LEFT NULL
+    """
+    t.execute(SQL(f"ALTER TABLE {MESSAGES} ADD COLUMN timestamp DOUBLE"))
+
+
+MIGRATIONS = [("2.0", _v2), ("3.0", _v3), ("4.0", _v4)]
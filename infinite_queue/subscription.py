@@ -1,6 +1,12 @@
-from infinite_queue.utils import UNCONFIRMED, SUBSCRIBER, MESSAGES, QUEUE, BLOCKS
-from jx_sqlite.sqlite import sql_update, quote_value, sql_insert, sql_query
-from jx_sqlite.utils import first_row
+from infinite_queue.utils import UNCONFIRMED, SUBSCRIBER, MESSAGES
+from jx_sqlite.sqlite import (
+    sql_update,
+    quote_value,
+    sql_insert,
+    sql_query,
+    quote_list,
+)
+from jx_sqlite.utils import first_row, rows
 from mo_json import json2value
 from mo_kwargs import override
 from mo_logs import Log
@@ -30,117 +36,110 @@ class Subscription:
             Log.error("not expected", cause=e)
 
     def pop_text(self):
+        for serial, content in self.pop_text_many(1):
+            return serial, content
+        return 0, None
+
+    def pop_many(self, n):
+        """
+        :param n: MAXIMUM NUMBER OF MESSAGES TO RETURN
+        :return: LIST OF (serial, message) PAIRS
+        """
+        try:
+            return [
+                (serial, json2value(content))
+                for serial, content in self.pop_text_many(n)
+            ]
+        except Exception as e:
+            Log.error("not expected", cause=e)
+
+    def pop_text_many(self, n):
+        """
+        OVERDUE MESSAGES ARE RESENT FIRST, THE REST ARE NEVER-SENT MESSAGES
+        :param n: MAXIMUM NUMBER OF MESSAGES TO RETURN
+        :return: LIST OF (serial, content) PAIRS
+        """
+        output = []
         with self.queue.broker.db.transaction() as t:
             # CHECK IF SOME MESSAGES CAN BE RESENT
             result = t.query(
                 SQL(
                     f"""
                     SELECT
-                        m.serial,
+                        u.serial,
                         m.content
                     FROM
                         {UNCONFIRMED} AS u
                     LEFT JOIN
-                        {MESSAGES} AS m ON m.serial=u.serial
+                        {MESSAGES} AS m ON m.queue = {quote_value(self.queue.id)} AND m.serial=u.serial
                     WHERE
-                        m.queue = {quote_value(self.queue.id)} AND
                         u.subscriber = {quote_value(self.id)} AND 
                         u.deliver_time <= {quote_value(Date.now().unix - self.confirm_delay_seconds)}
                     ORDER BY
                         u.deliver_time
                     LIMIT
-                        1
+                        {quote_value(n)}
                     """
                 )
             )
-
+            now = Date.now()
             if result.data:
-                record = first_row(result)
-                # RECORD IT WAS SENT AGAIN
-                now = Date.now()
-                t.execute(
-                    sql_update(
-                        UNCONFIRMED,
-                        {
-                            "set": {"deliver_time": now},
-                            "where": {
-                                "eq": {"subscriber": self.id, "serial": record.serial}
-                            },
-                        },
-                    )
+                output.extend(
+                    (serial, content if content is not None else self._archived(serial))
+                    for serial, content in result.data
                 )
-                t.execute(sql_update(SUBSCRIBER, {"set": {"last_emit_timestamp": now}}))
-                return record.serial, record.content
-
-            # IS THERE A NEVER-SENT MESSAGE?
-            serial = self._next_serial(t)
-            if not serial:
-                return 0, None
-
-            result = t.query(
-                sql_query(
-                    {
-                        "select": "content",
-                        "from": MESSAGES,
-                        "where": {"eq": {"queue": self.queue.id, "serial": serial}},
-                    }
-                )
-            )
-
-            if not result.data:
-                result = t.query(
+                # RECORD THEY WERE SENT AGAIN
+                t.execute(
                     SQL(
                         f"""
-                        SELECT 
-                            serial,
-                            path
-                        FROM 
-                            {BLOCKS}
+                        UPDATE {UNCONFIRMED}
+                        SET deliver_time = {quote_value(now)}
                         WHERE
-                            queue = {quote_value(self.queue.id)} AND
-                            serial <= {quote_value(serial)}
-                        ORDER BY
-                            serial DESC
-                        LIMIT 1
+                            subscriber = {quote_value(self.id)} AND
+                            serial IN {quote_list(serial for serial, _ in output)}
                         """
                     )
                 )
 
-                if not result.data:
-                    Log.error("not expected")
+            # ARE THERE NEVER-SENT MESSAGES?
+            start, end = self._next_serials(t, n - len(output))
+            if start < end:
+                contents = self._get_contents(t, start, end)
+                output.extend((serial, contents[serial]) for serial in range(start, end))
 
-                row = first_row(result)
-                self.queue.load(path=row.path, start=row.serial)
-
-                # RETRY
-                result = t.query(
-                    sql_query(
-                        {
-                            "select": "content",
-                            "from": MESSAGES,
-                            "where": {"eq": {"queue": self.queue.id, "serial": serial}},
-                        }
+                # RECORD THEY WERE SENT
+                t.execute(
+                    sql_insert(
+                        UNCONFIRMED,
+                        [
+                            {"subscriber": self.id, "serial": serial, "deliver_time": now}
+                            for serial in range(start, end)
+                        ],
                     )
                 )
 
-                if not result.data:
-                    Log.error("not expected")
-
-            content = first_row(result).content
-
-            # RECORD IT WAS SENT
-            now = Date.now()
-            t.execute(
-                sql_insert(
-                    UNCONFIRMED,
-                    {"subscriber": self.id, "serial": serial, "deliver_time": now},
+            if output:
+                t.execute(
+                    sql_update(
+                        SUBSCRIBER,
+                        {
+                            "set": {"last_emit_timestamp": now},
+                            "where": {"eq": {"id": self.id}},
+                        },
+                    )
                 )
-            )
-            t.execute(sql_update(SUBSCRIBER, {"set": {"last_emit_timestamp": now}}))
-
-            return serial, content
+        return output
 
     def confirm(self, serial):
+        self.confirm_many([serial])
+
+    def confirm_many(self, serials):
+        """
+        CONFIRM ALL GIVEN serials, IN ANY ORDER
+        """
+        serials = list(serials)
+        if not serials:
+            return
         with self.queue.broker.db.transaction() as t:
             t.execute(
                 SQL(
@@ -148,7 +147,7 @@ class Subscription:
                 DELETE FROM {UNCONFIRMED}
                 WHERE
                     subscriber = {quote_value(self.id)} AND
-                    serial = {quote_value(serial)}
+                    serial IN {quote_list(serials)}
             """
                 )
             )
@@ -163,44 +162,116 @@ class Subscription:
                     ), 
                     next_emit_serial               
                 )-1
+                WHERE id = {quote_value(self.id)}
             """
                 )
             )
 
-    def _next_serial(self, t):
+    def confirm_through(self, serial):
+        """
+        CONFIRM ALL MESSAGES UP TO, AND INCLUDING, serial
+        FOR LISTENERS THAT PROCESS MESSAGES IN ORDER
+        """
+        with self.queue.broker.db.transaction() as t:
+            t.execute(
+                SQL(
+                    f"""
+                DELETE FROM {UNCONFIRMED}
+                WHERE
+                    subscriber = {quote_value(self.id)} AND
+                    serial <= {quote_value(serial)}
+            """
+                )
+            )
+            # NOTHING AT, OR BELOW, serial IS UNCONFIRMED; NO NEED TO SCAN
+            t.execute(
+                SQL(
+                    f"""
+                UPDATE {SUBSCRIBER} SET last_confirmed_serial=MAX(
+                    last_confirmed_serial,
+                    MIN({quote_value(serial)}, next_emit_serial-1)
+                )
+                WHERE id = {quote_value(self.id)}
+            """
+                )
+            )
+
+    def _get_contents(self, t, start, end):
         """
         EXPECTING OPEN TRANSACTION t
+        :return: MAP FROM serial TO content, FOR ALL start <= serial < end
         """
+        contents = self._query_contents(t, start, end)
+        for serial in range(start, end):
+            if serial not in contents:
+                # NOT IN DATABASE, READ FROM BACKING
+                contents[serial] = self._archived(serial)
+        return contents
 
-        # TEST IF THERE ARE MESSAGES TO EMIT
+    def _archived(self, serial):
+        """
+        :return: content OF AN ARCHIVED MESSAGE, VIA THE BROKER'S BLOCK CACHE
+        """
+        block = self.queue.block_index.find(serial)
+        if not block:
+            Log.error("not expected")
+        content = self.queue.load(path=block.path, start=block.serial, serial=serial)
+        if content is None:
+            Log.error("not expected")
+        return content
+
+    def _query_contents(self, t, start, end):
         result = t.query(
             SQL(
                 f"""
-            SELECT
-                s.next_emit_serial
-            FROM
-                {SUBSCRIBER} AS s 
-            LEFT JOIN
-                {QUEUE} AS q ON q.id = s.queue
-            WHERE
-                s.id = {quote_value(self.id)} AND
-                q.next_serial > s.next_emit_serial
-        """
+                SELECT
+                    serial,
+                    content
+                FROM
+                    {MESSAGES}
+                WHERE
+                    queue = {quote_value(self.queue.id)} AND
+                    {quote_value(start)} <= serial AND
+                    serial < {quote_value(end)}
+                """
             )
         )
+        return {r.serial: r.content for r in rows(result)}
 
-        if not result.data:
+    def _next_serials(self, t, n):
+        """
+        EXPECTING OPEN TRANSACTION t
+        CLAIM UP TO n NEVER-SENT SERIALS, NO FURTHER THAN THE LOOK-AHEAD (WHICH
+        Broker.clean() KEEPS IN THE DATABASE)
+        :return: (start, end) RANGE OF SERIALS CLAIMED
+        """
+        result = t.query(
+            sql_query(
+                {
+                    "select": ["next_emit_serial", "look_ahead_serial"],
+                    "from": SUBSCRIBER,
+                    "where": {"eq": {"id": self.id}},
+                }
+            )
+        )
+        row = first_row(result)
+        start = row.next_emit_serial
+        end = min(
+            start + n,
+            start + max(1, row.look_ahead_serial),
+            self.queue.next_serial,
+        )
+        if start >= end:
             # NO NEW MESSAGES
-            return None
+            return start, start
 
-        next_id = first_row(result).next_emit_serial
         t.execute(
             sql_update(
                 SUBSCRIBER,
                 {
-                    "set": {"next_emit_serial": next_id + 1},
+                    "set": {"next_emit_serial": end},
                     "where": {"eq": {"id": self.id}},
                 },
             )
         )
-        return next_id
+        return start, end
@@ -8,9 +8,16 @@
 # Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
 #
 
+import itertools
+import os
+
 from mo_files import File
+from mo_http.big_data import ibytes2ilines
+from mo_json import json2value, value2json
 from mo_kwargs import override
+from mo_logs import Log
 from mo_times import Date
+from pyLibrary.compress import EXTENSIONS, compress, idecompress, sread, verify_codec
 
 TABLE_PREFIX = "irq"
 VERSION_TABLE = "version"
@@ -20,20 +27,104 @@ SUBSCRIBER = "subscriber"
 MESSAGES = "messages"
 UNCONFIRMED = "unconfirmed"
 
+RESTART_LINES = 100  # LINES BETWEEN RESTART POINTS IN AN ARCHIVE
+
 
 class DirectoryBacking:
     @override
-    def __init__(self, directory):
+    def __init__(self, directory, codec="none", level=None):
+        """
+        :param directory: WHERE TO PUT THE ARCHIVES
+        :param codec: ONE OF none, gzip, zlib, lzma
+        :param level: COMPRESSION LEVEL (None FOR THE CODEC DEFAULT)
+        """
         self.dir = File(directory)
+        self.codec = verify_codec(codec)
+        self.level = level
 
     def write_lines(self, key, lines):
-        (self.dir / key).set_extension("json").write_lines(lines)
+        """
+        WRITE lines, ONE COMPRESSED MEMBER PER RESTART_LINES LINES,
+        AND A SIDECAR WITH THE BYTE OFFSET OF EACH MEMBER
+        """
+        file = self._file(key, self.codec)
+        if not file.parent.exists:
+            file.parent.create()
+        # A STALE SIDECAR MUST NOT POINT INTO THE NEW FILE
+        self._index(key).delete()
+        offsets = []
+        with open(file.abspath, "wb") as f:
+            page = []
+            for line in itertools.chain(lines, [None]):
+                if line is not None:
+                    page.append(line)
+                if page and (line is None or len(page) == RESTART_LINES):
+                    offsets.append(f.tell())
+                    data = "".join(l + "\n" for l in page).encode("utf8")
+                    f.write(compress(self.codec, data, self.level))
+                    page = []
+            # DURABLE BEFORE THE CALLER RECORDS THE BLOCK
+            f.flush()
+            os.fsync(f.fileno())
+        for codec in EXTENSIONS:
+            if codec != self.codec:
+                # AN OLDER COPY, WRITTEN WITH ANOTHER CODEC
+                self._file(key, codec).delete()
+        self._index(key).write(value2json({"restart": RESTART_LINES, "offsets": offsets}))
 
     def url(self, key):
-        return "file:///" + (self.dir / key).set_extension("json").abspath
+        return "file:///" + self._file(key, self.codec).abspath
+
+    def read_lines(self, key, start=0, end=None):
+        """
+        :param start: INDEX OF THE FIRST LINE TO READ
+        :param end: INDEX AFTER THE LAST LINE TO READ (None FOR ALL)
+        """
+        codec, file = self._find(key)
+        index = self._index(key)
+        with open(file.abspath, "rb") as f:
+            i = 0
+            size = None
+            if index.exists:
+                index = json2value(index.read())
+                first = min(start // index.restart, len(index.offsets) - 1)
+                if first < 0:
+                    return
+                f.seek(index.offsets[first])
+                i = first * index.restart
+                if end is not None:
+                    last = -(-end // index.restart)  # FIRST MEMBER NOT NEEDED
+                    if last < len(index.offsets):
+                        size = index.offsets[last] - index.offsets[first]
+            # WITHOUT A SIDECAR, READ FROM THE BEGINNING
+
+            for line in ibytes2ilines(idecompress(codec, sread(f, size))):
+                if end is not None and i >= end:
+                    break
+                if i >= start:
+                    yield line
+                i += 1
+
+    def delete_key(self, key):
+        for codec in EXTENSIONS:
+            self._file(key, codec).delete()
+        self._index(key).delete()
+
+    def _find(self, key):
+        """
+        :return: (codec, file) OF THE ARCHIVE, WHICH MAY PRE-DATE THE CURRENT codec
+        """
+        for codec in [self.codec] + [c for c in EXTENSIONS if c != self.codec]:
+            file = self._file(key, codec)
+            if file.exists:
+                return codec, file
+        Log.error("{{key}} does not exist", key=key)
+
+    def _file(self, key, codec):
+        return self.dir / (key + EXTENSIONS[codec])
 
-    def read_lines(self, key):
-        return (self.dir / key).set_extension("json").read_lines()
+    def _index(self, key):
+        return self.dir / (key + ".idx")
 
 
 def _path(timestamp):
@@ -1,13 +1,28 @@
+from infinite_queue import schema, broker as broker_module, queue as queue_module
+from infinite_queue.block_cache import BlockCache
+from infinite_queue.block_index import BlockIndex
 from infinite_queue.broker import Broker
-from infinite_queue.utils import MESSAGES, SUBSCRIBER, _path
+from infinite_queue.utils import (
+    MESSAGES,
+    SUBSCRIBER,
+    QUEUE,
+    UNCONFIRMED,
+    VERSION_TABLE,
+    BLOCKS,
+    DirectoryBacking,
+    _path,
+)
 from jx_base.expressions import NULL
-from jx_sqlite.sqlite import sql_query, sql_update
-from jx_sqlite.utils import first_row
+from jx_sqlite.sqlite import Sqlite, sql_insert, sql_query, sql_update
+from jx_sqlite.utils import first_row, rows
+from mo_dots import Data
 from mo_files import File
-from mo_json import json2value
+from mo_json import json2value, value2json
 from mo_logs import startup, constants, Log
+from mo_sql import SQL
 from mo_testing.fuzzytestcase import FuzzyTestCase
 from mo_times import Date
+from pyLibrary.compress import EXTENSIONS
 
 config = None
 broker = None
@@ -53,6 +68,171 @@ class TestDirectory(FuzzyTestCase):
         for line in content.split("/n"):
             self.assertAlmostEqual(json2value(line), data)
 
+    def test_push_many(self):
+        queue = broker.get_or_create_queue("test_push_many")
+        data = [{"a": i} for i in range(5)]
+        serials = queue.push_many(data)
+        self.assertEqual(list(serials), [1, 2, 3, 4, 5])
+        self.assertEqual(queue.push({"a": 5}), 6)
+
+        subscriber = broker.get_subscriber("test_push_many")
+        for expected_serial, expected in enumerate(data, 1):
+            serial, content = subscriber.pop()
+            subscriber.confirm(serial)
+            self.assertEqual(serial, expected_serial)
+            self.assertAlmostEqual(content, expected)
+            self.assertEqual(content.etl.last().queue.serial, serial)
+
+    def test_pop_many(self):
+        queue = broker.get_or_create_queue("test_pop_many")
+        data = [{"a": i} for i in range(5)]
+        queue.push_many(data)
+
+        # LOOK-AHEAD LIMITS THE PREFETCH
+        subscriber = broker.replay(
+            "test_pop_many", confirm_delay_seconds=0, look_ahead_serial=3
+        )
+        messages = subscriber.pop_many(10)
+        self.assertEqual([s for s, _ in messages], [1, 2, 3])
+        self.assertAlmostEqual([m for _, m in messages], data[:3])
+
+        # UNCONFIRMED ARE RESENT FIRST
+        subscriber.confirm(2)
+        messages = subscriber.pop_many(4)
+        self.assertEqual([s for s, _ in messages], [1, 3, 4, 5])
+
+    def test_confirm_many(self):
+        queue = broker.get_or_create_queue("test_confirm_many")
+        queue.push_many([{"a": i} for i in range(6)])
+        subscriber = broker.replay("test_confirm_many", look_ahead_serial=10)
+        self.assertEqual(len(subscriber.pop_many(6)), 6)
+
+        subscriber.confirm_many([1, 2, 4])
+        self.assertEqual(self.lastConfirmedSerial(subscriber), 2)
+
+        subscriber.confirm_through(5)
+        self.assertEqual(self.lastConfirmedSerial(subscriber), 5)
+
+        subscriber.confirm_through(100)
+        self.assertEqual(self.lastConfirmedSerial(subscriber), 6)
+
+    def test_serial_recovery(self):
+        queue = broker.get_or_create_queue("test_serial_recovery")
+        queue.push_many([{"a": i} for i in range(3)])
+
+        # HIGH-WATER MARK IS AHEAD OF THE MESSAGES
+        with broker.db.transaction() as t:
+            result = t.query(
+                sql_query(
+                    {
+                        "select": "next_serial",
+                        "from": QUEUE,
+                        "where": {"eq": {"id": queue.id}},
+                    }
+                )
+            )
+        self.assertGreater(first_row(result).next_serial, 4)
+
+        # SIMULATE RESTART
+        broker.queues.remove(queue)
+        queue = broker.get_or_create_queue("test_serial_recovery")
+        self.assertEqual(queue.next_serial, 4)
+        self.assertEqual(queue.push({"a": 3}), 4)
+
+    def test_upgrade_schema(self):
+        filename = File(config.broker.backing.directory) / "v1" / "db.sqlite"
+
+        # BUILD A VERSION 1.0 DATABASE
+        db = Sqlite(filename=filename.abspath)
+        schema.setup(Data(db=db))
+        with db.transaction() as t:
+            t.execute(
+                sql_insert(
+                    UNCONFIRMED,
+                    [
+                        {"subscriber": 1, "serial": 1, "deliver_time": 1},
+                        {"subscriber": 1, "serial": 1, "deliver_time": 2},
+                    ],
+                )
+            )
+            t.execute(
+                sql_insert(
+                    QUEUE,
+                    {
+                        "id": 1,
+                        "name": "old",
+                        "next_serial": 21,
+                        "block_size_mb": 8,
+                        "block_start": 11,
+                        "block_end": 21,
+                    },
+                )
+            )
+            t.execute(
+                sql_insert(
+                    BLOCKS,
+                    [
+                        {"queue": 1, "serial": 1, "path": "2020/01/01", "last_used": 1},
+                        {"queue": 1, "serial": 11, "path": "2020/01/02", "last_used": 2},
+                    ],
+                )
+            )
+        db.close()
+
+        old_broker = Broker(
+            database={"filename": filename.abspath}, backing=config.broker.backing
+        )
+        try:
+            with old_broker.db.transaction() as t:
+                version = first_row(t.query(sql_query({"from": VERSION_TABLE}))).version
+                indexes = t.query(
+                    SQL(
+                        f"SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='{UNCONFIRMED}'"
+                    )
+                )
+                unconfirmed = t.query(sql_query({"from": UNCONFIRMED}))
+                blocks = t.query(
+                    sql_query(
+                        {
+                            "select": ["serial", "last_serial", "first_timestamp"],
+                            "from": BLOCKS,
+                            "orderby": "serial",
+                        }
+                    )
+                )
+        finally:
+            old_broker.close()
+
+        self.assertEqual(version, schema.MIGRATIONS[-1][0])
+        self.assertIn(UNCONFIRMED + "_deliver_time", [n for n, in indexes.data])
+        self.assertAlmostEqual(
+            list(rows(unconfirmed)), [{"subscriber": 1, "serial": 1, "deliver_time": 2}]
+        )
+        self.assertAlmostEqual(
+            list(rows(blocks)),
+            [
+                {"serial": 1, "last_serial": 10, "first_timestamp": Date("2020-01-01").unix},
+                {"serial": 11, "last_serial": 20, "first_timestamp": Date("2020-01-02").unix},
+            ],
+        )
+
+    def test_block_index(self):
+        queue = broker.get_or_create_queue("test_block_index", block_size_mb=0)
+        start = Date.now()
+        queue.push_many([{"a": i} for i in range(3)])
+        queue.flush()
+
+        self.assertEqual(len(queue.block_index), 3)
+        block = queue.block_index.find(2)
+        self.assertEqual(block.serial, 2)
+        self.assertEqual(block.last_serial, 2)
+        self.assertEqual(block.path, _path(start))
+        self.assertGreaterEqual(block.first_timestamp, start.unix)
+        self.assertEqual(queue.block_index.find(4), None)
+
+        # SAME INDEX WHEN LOADED FROM DATABASE
+        self.assertAlmostEqual(list(BlockIndex(queue)), list(queue.block_index))
+
     def test_repeat(self):
         queue = broker.get_or_create_queue("test2")
         data = {"a": 1, "b": 2}
@@ -149,6 +329,36 @@ class TestDirectory(FuzzyTestCase):
         self.assertRaises(Exception, self.assertMessageExists, serial1, queue.id)
         self.assertMessageExists(serial2, queue.id)
 
+    def test_clean_by_range(self):
+        queue = broker.get_or_create_queue("test_clean_by_range", block_size_mb=0)
+        # ENSURE THERE IS NO LOOK-AHEAD
+        with broker.db.transaction() as t:
+            t.execute(
+                sql_update(
+                    SUBSCRIBER,
+                    {
+                        "set": {"look_ahead_serial": 0},
+                        "where": {"eq": {"id": queue.id}},
+                    },
+                )
+            )
+        queue.push_many([{"a": i} for i in range(10)])
+        broker.replay("test_clean_by_range", next_emit_serial=5, look_ahead_serial=2)
+        queue.flush()
+        self.assertEqual(broker._unreachable(queue), [(1, 5), (7, 11)])
+
+        old_batch, broker_module.CLEAN_BATCH = broker_module.CLEAN_BATCH, 2
+        try:
+            broker.clean()
+        finally:
+            broker_module.CLEAN_BATCH = old_batch
+
+        for serial in range(1, 11):
+            if serial in (5, 6):
+                self.assertMessageExists(serial, queue.id)
+            else:
+                self.assertRaises(Exception, self.assertMessageExists, serial, queue.id)
+
     def test_recover_messages_from_backing(self):
         queue = broker.get_or_create_queue("test5", block_size_mb=0)
         # ENSURE THERE IS NO LOOK-AHEAD
@@ -179,18 +389,180 @@ class TestDirectory(FuzzyTestCase):
         self.assertRaises(Exception, self.assertMessageExists, serial1, queue.id)
         self.assertRaises(Exception, self.assertMessageExists, serial2, queue.id)
 
+        # REPLAY IS SERVED FROM BACKING, NOT RE-INSERTED INTO DATABASE
+        misses = broker.block_cache.misses
         subscriber2 = broker.replay("test5", look_ahead_serial=0)
-        serial1 = subscriber2.pop()[0]
+        serial, content = subscriber2.pop()
+        self.assertEqual(serial, serial1)
+        self.assertAlmostEqual(content, data1)
+        self.assertEqual(broker.block_cache.misses, misses + 1)
+        self.assertRaises(Exception, self.assertMessageExists, serial1, queue.id)
+
+        hits = broker.block_cache.hits
+        subscriber3 = broker.replay("test5", look_ahead_serial=0)
+        serial, content = subscriber3.pop()
+        self.assertEqual(serial, serial1)
+        self.assertAlmostEqual(content, data1)
+        self.assertEqual(broker.block_cache.hits, hits + 1)
+
+        subscriber2.confirm(serial1)
+        serial, content = subscriber2.pop()
+        self.assertEqual(serial, serial2)
+        self.assertAlmostEqual(content, data2)
+
+    def lastConfirmedSerial(self, subscriber):
+        with broker.db.transaction() as t:
+            result = t.query(
+                sql_query(
+                    {
+                        "select": "last_confirmed_serial",
+                        "from": SUBSCRIBER,
+                        "where": {"eq": {"id": subscriber.id}},
+                    }
+                )
+            )
+        return first_row(result).last_confirmed_serial
+
+    def test_flush_uses_timestamp_column(self):
+        queue = broker.get_or_create_queue("test_flush_timestamp", block_size_mb=0)
+        queue.push_many([{"a": 1}, {"a": 2}])
+        with broker.db.transaction() as t:
+            # MESSAGE 1 IS FROM BEFORE THE timestamp COLUMN
+            t.execute(
+                SQL(
+                    f"UPDATE {MESSAGES} SET timestamp=NULL WHERE queue={queue.id} AND serial=1"
+                )
+            )
+            t.execute(
+                sql_update(
+                    MESSAGES,
+                    {
+                        "set": {"timestamp": Date("2020-01-01")},
+                        "where": {"eq": {"queue": queue.id, "serial": 2}},
+                    },
+                )
+            )
         queue.flush()
+
+        self.assertEqual(queue.block_index.find(1).path, _path(Date.now()))
+        self.assertEqual(queue.block_index.find(2).path, "2020/01/01")
+        self.assertEqual(queue.block_index.find(2).first_timestamp, Date("2020-01-01").unix)
+
+    def test_flush_in_pages(self):
+        queue = broker.get_or_create_queue("test_flush_in_pages", block_size_mb=0.001)
+        data = [{"a": i, "b": "x" * 50} for i in range(30)]
+        queue.push_many(data)
+
+        old_page, queue_module.FLUSH_PAGE = queue_module.FLUSH_PAGE, 4
+        try:
+            queue.flush()
+        finally:
+            queue_module.FLUSH_PAGE = old_page
+
+        # BLOCKS COVER ALL MESSAGES, IN ORDER, AND ONLY THE LAST IS PARTIAL
+        blocks = list(queue.block_index)
+        self.assertGreater(len(blocks), 2)
+        self.assertEqual(blocks[0].serial, 1)
+        self.assertEqual(blocks[-1].last_serial, 30)
+        for prev, curr in zip(blocks, blocks[1:]):
+            self.assertEqual(prev.last_serial + 1, curr.serial)
+            lines = list(
+                broker.backing.read_lines(queue._key(path=prev.path, serial=prev.serial))
+            )
+            self.assertEqual(len(lines), prev.last_serial - prev.serial + 1)
+            self.assertLessEqual(sum(len(l) + 1 for l in lines), 0.001 * 1024 * 1024)
+
+        # REPLAY FROM BACKING
         broker.clean()
-        self.assertMessageExists(serial1, queue.id)
-        self.assertRaises(Exception, self.assertMessageExists, serial2, queue.id)
+        subscriber = broker.replay("test_flush_in_pages", look_ahead_serial=100)
+        messages = subscriber.pop_many(100)
+        self.assertAlmostEqual([m for _, m in messages], data)
 
-        subscriber2.confirm(serial1)
+    def test_tail_segments(self):
+        # FOUR MESSAGES FIT IN A BLOCK
+        queue = broker.get_or_create_queue("test_tail_segments", block_size_mb=0.01)
+        data = [{"a": i, "b": "x" * 2000} for i in range(6)]
+        directory = File(config.broker.backing.directory) / queue.name / _path(Date.now())
+
+        queue.push_many(data[:2])
+        queue.flush()
+        first_segment = (directory / "1.json").read()
+        queue.push_many(data[2:3])
+        queue.flush()
+
+        # SEGMENTS ARE APPENDED, NOT REWRITTEN
+        self.assertEqual([b.serial for b in queue.block_index], [1, 3])
+        self.assertEqual((directory / "1.json").read(), first_segment)
+        self.assertTrue((directory / "3.json").exists)
+
+        # ENOUGH FOR A FULL BLOCK: MERGE
+        queue.push_many(data[3:])
         queue.flush()
+        self.assertAlmostEqual(
+            [(b.serial, b.last_serial) for b in queue.block_index], [(1, 4), (5, 6)]
+        )
+        self.assertFalse((directory / "3.json").exists)
+
         broker.clean()
-        self.assertRaises(Exception, self.assertMessageExists, serial1, queue.id)
-        self.assertMessageExists(serial2, queue.id)
+        subscriber = broker.replay("test_tail_segments", look_ahead_serial=100)
+        self.assertAlmostEqual([m for _, m in subscriber.pop_many(100)], data)
+
+    def test_block_cache_eviction(self):
+        backing = DirectoryBacking(directory=config.broker.backing.directory)
+        line = "x" * 1000
+        for key in ["cache/1", "cache/2", "cache/3"]:
+            backing.write_lines(key, [line] * 400)
+
+        cache = BlockCache(backing, size_mb=0.25)  # ROOM FOR TWO PAGES
+        cache.get_line("cache/1", 0)
+        cache.get_line("cache/2", 0)
+        cache.get_line("cache/1", 0)
+        cache.get_line("cache/3", 0)  # EVICTS cache/2
+        cache.get_line("cache/1", 0)
+        stats = cache.stats
+        self.assertEqual(
+            (stats["hits"], stats["misses"], stats["pages"]), (2, 3, 2)
+        )
+        cache.get_line("cache/2", 0)
+        self.assertEqual(cache.misses, 4)
+
+    def test_read_lines_from_restart_point(self):
+        backing = DirectoryBacking(directory=config.broker.backing.directory)
+        lines = [value2json({"line": i}) for i in range(250)]
+        backing.write_lines("restart/1", lines)
+
+        self.assertEqual(list(backing.read_lines("restart/1", 150, 160)), lines[150:160])
+        self.assertEqual(list(backing.read_lines("restart/1", 245)), lines[245:])
+        self.assertEqual(list(backing.read_lines("restart/1")), lines)
+
+        # ONE PAGE IS READ FROM ITS RESTART POINT
+        cache = BlockCache(backing, size_mb=1)
+        self.assertEqual(cache.get_line("restart/1", 199), lines[199])
+        self.assertEqual(cache.get_line("restart/1", 250), None)
+        self.assertEqual(cache.stats["pages"], 2)
+
+    def test_codecs(self):
+        lines = [value2json({"line": i, "text": "hello world " * (i % 7)}) for i in range(250)]
+        for codec in ["none", "gzip", "zlib", "lzma"]:
+            backing = DirectoryBacking(
+                directory=config.broker.backing.directory, codec=codec, level=1
+            )
+            key = "codec/" + codec
+            backing.write_lines(key, lines)
+            self.assertTrue(backing.url(key).endswith(EXTENSIONS[codec]))
+            self.assertEqual(list(backing.read_lines(key)), lines)
+            self.assertEqual(list(backing.read_lines(key, 150, 160)), lines[150:160])
+            self.assertEqual(list(backing.read_lines(key, 199, 201)), lines[199:201])
+
+            # ARCHIVES WRITTEN WITH ANOTHER CODEC ARE STILL READABLE
+            other = DirectoryBacking(directory=config.broker.backing.directory, codec="gzip")
+            self.assertEqual(list(other.read_lines(key, 245)), lines[245:])
+
+            # REWRITING WITH ANOTHER CODEC LEAVES ONE COPY
+            other.write_lines(key, lines[:10])
+            self.assertEqual(list(backing.read_lines(key)), lines[:10])
+            other.delete_key(key)
+            self.assertRaises(Exception, list, backing.read_lines(key))
 
     def assertMessageExists(self, serial, queue_id):
         """
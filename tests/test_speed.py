@@ -1,8 +1,11 @@
 from infinite_queue.broker import Broker
+from infinite_queue.utils import DirectoryBacking
 from mo_files import File
+from mo_json import value2json
 from mo_logs import startup, constants, Log
 from mo_testing.fuzzytestcase import FuzzyTestCase
 from mo_threads import Till
+from mo_times import Timer
 
 config = None
 broker = None
@@ -46,3 +49,69 @@ class TestDirectory(FuzzyTestCase):
         else:
             Log.error("not enough data to run test")
         Log.note("push rate of {{rate}}/second", rate=rate)
+
+    def test_push_many_speed(self):
+        queue = broker.get_or_create_queue("test_push_many")
+
+        duration = 10
+        batch_size = 100
+        rate = None
+        data = [
+            {chr(i): i for i in range(65, 91)}
+            for _ in range(1000)
+        ]
+
+        done = Till(seconds=duration)
+        for i in range(100):
+            queue.push_many(data[:batch_size])
+            if done:
+                rate = (i + 1) * batch_size / duration
+                break
+        else:
+            Log.error("not enough data to run test")
+        Log.note("push_many rate of {{rate}}/second", rate=rate)
+
+    def test_codec_speed(self):
+        """
+        COMPRESSION RATIO, FLUSH THROUGHPUT, AND REPLAY THROUGHPUT FOR EACH CODEC
+        """
+        message_sets = {
+            "small": [{chr(i): n * i for i in range(65, 91)} for n in range(20000)],
+            "text": [
+                {"id": n, "text": "the quick brown fox jumps over the lazy dog " * (n % 20)}
+                for n in range(20000)
+            ],
+        }
+        directory = File(config.broker.backing.directory) / "codec_speed"
+        for set_name, messages in message_sets.items():
+            lines = [value2json(m, sort_keys=True) for m in messages]
+            raw = sum(len(l) + 1 for l in lines)
+            for codec, level in [
+                ("none", None),
+                ("gzip", 1),
+                ("gzip", 6),
+                ("gzip", 9),
+                ("zlib", 6),
+                ("lzma", 0),
+                ("lzma", 6),
+            ]:
+                backing = DirectoryBacking(directory=directory, codec=codec, level=level)
+                key = set_name + "/" + codec + "/" + str(level)
+
+                with Timer("flush") as flush:
+                    backing.write_lines(key, lines)
+                with Timer("replay") as replay:
+                    count = sum(1 for _ in backing.read_lines(key))
+                self.assertEqual(count, len(lines))
+
+                size = backing._file(key, codec).length
+                Log.note(
+                    "{{set}} {{codec}}({{level}}): ratio={{ratio|round(places=3)}} flush={{flush|comma}}/second replay={{replay|comma}}/second",
+                    set=set_name,
+                    codec=codec,
+                    level=level,
+                    ratio=raw / size,
+                    flush=int(len(lines) / flush.duration.seconds),
+                    replay=int(len(lines) / replay.duration.seconds),
+                )
+        directory.delete()